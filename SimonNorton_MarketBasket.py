@@ -3,64 +3,63 @@
 # User input parameters:
 #    --gzip_filename : Input file of generated data.
 #    --reportfile    : Name of csv file for final output.
-#    --line_limit    : Approximate number of lines per intermediary file.
+#    --line_limit    : Approximate number of lines per batch of baskets handed to a worker process.
+#    --processes     : Number of worker processes counting batches of baskets in parallel.
 
 # General Workflow:
 #
-# - "create_subfiles" function loops through the input file line by line copying each one
-#   to a new file until the line_limit parameter is reached.  It includes logic so that a
-#   basket is not divided up between multiple files.  All the lines for any given basket
-#   are contained in one file.
+# - "read_batches" function loops through the buffered input file line by line collecting each one
+#   into a batch until the line_limit parameter is reached.  The input file is grouped by
+#   basket, so a new batch is only started where the basket id changes and a basket is not
+#   divided up between multiple batches.  All the lines for any given basket are contained in one batch.
+#   Nothing is written to disk; the batches go straight from the gzip file to the worker processes.
 #
-# - "proc_baskets" function transforms each fragment file from the input format into the
-#   output format of distinct (Product_1, Product_2) tuples found in each basket.
-#   This function returns a dictionary of every occurence of a tuple found in a fragment file.
+# - "count_batches" function hands the batches to the pool of worker processes, keeping no more than
+#   BATCHES_IN_FLIGHT of them read ahead at any time, and hands back the results in batch order.
 #
-# - "count_product_tuples" function takes the aforementioned dictionary and sums the tuples
-#   together, reducing the number of lines to be written out to more intermediary files that
-#   are chunks for the final report file.
+# - "proc_and_count" function transforms each batch from the input format into the
+#   output format of distinct (Product_1, Product_2) tuples found in each basket, counting
+#   each tuple as it is generated.  The summed tuples are handed back to the main process
+#   as a Counter.
 #
 # - "proc_subdata" finally manipulates the data into the report.
-#   For each fragment file of tuple counts (primary), each one is read in sequential order and compared
-#   to every other fragment file (secondary).   
-#   - Tuples from secondary files that match to tuples in the primary file are summed together in the primary
-#     file and removed from the secondary file.  This ensures the same matching tuple does not get counted 
-#     more than once.
-#   - Once the primary file has been compared for matching tuples against all available secondaries, the updated
-#     primary content (DataFrame) is appended to the final report file.
-#   - The primary file loop then moves on to the next tuple counts file.  This file was the first "secondary" compared 
-#     in the previous loop, so any tuples that matched to the first primary loop have already been removed from
-#     this file.  At this point, this file, now promoted from secondary to primary, represents a new set of distinct tuples
-#     that do not yet exist in the final report file.
-#     NOTE:  If a secondary file becomes empty before it's turn as a primary, it will just be skipped over as we can
-#     assume that all of it's original contents have been accounted for.
+#   Each batch's Counter is summed, as soon as it is handed back in batch order, into a single Counter keyed by
+#   the (Product_1, Product_2) tuple, packed into one int.  Because the only operation needed across
+#   batches is a sum, there is no need to compare batches against each other; once every
+#   batch has been counted the Counter holds the final totals and is written out as the report file.
 #
 # MEMORY CONSTRAINTS:
-# - Splitting the gzip file by reading line-by-line uses almost no memory.
+# - Reading the gzip file line-by-line uses almost no memory.  At most BATCHES_IN_FLIGHT batches of about
+#   line_limit lines each are held waiting for, or being counted by, the worker processes.
 # - The processing of baskets into product tuples relies on dictionaries and a csv reader which also works on a 
-#   line-by-line file read.  The memory use of the dictionaries is controlled by the line_limit parameter, so a fixed
+#   line-by-line read of the batch.  The memory use of the dictionaries is controlled by the line_limit parameter, so a fixed
 #   line_limit can help keep memory usage down even if the file size continues to grow.  The script will take longer,
-#   but memory should stay about the same.
-# - The bulk of memory comes from the use of DataFrames for the consolidating and file comparisons.  The line_limit parameter
-#   affects RAM usage here as well, but this is a good area for improvement if DataFrames can be substituted for more advanced
-#   use of other data structures, or perhaps a file based database like Sqlite.   
+#   but memory should stay about the same.  Each of the --processes workers holds one batch's dictionaries at a time,
+#   so this part of the memory use grows with the number of processes.  Total MiBs used only measures the main process.
+# - The bulk of memory comes from the consolidating Counter in proc_subdata, which holds one entry per distinct
+#   (Product_1, Product_2) tuple.  That is bounded by the number of products rather than the number of lines in the
+#   input file, and the line_limit parameter no longer affects it.
 
 
 
 
 import os
 import psutil as psu
-import glob
 import csv
 import gzip
+import io
 import argparse
 import collections as cll
 import itertools as itl
-import pandas as pd
-import gc
+import multiprocessing as mp
 import time 
 
 MiB = 1024**2 # MebiBytes or MegaBytes multiplier constant
+PAIR_SHIFT = 32 # (Product_1, Product_2) tuples are counted as one int: Product_1 in the high bits, Product_2 in the low bits
+PAIR_MASK = (1 << PAIR_SHIFT) - 1
+READ_BUFFER_SIZE = 128 * 1024 # Bytes of decompressed input buffered per read, same as CPython's own gzip module
+WRITE_BUFFER_SIZE = 1 * MiB # Bytes buffered per write to the report file
+BATCHES_IN_FLIGHT = 64 # Most batches of input lines read ahead of the consolidation at any time
 
 def show_mem():
     this_proc = psu.Process(os.getpid())
@@ -70,176 +69,87 @@ def show_mem():
 
 
 
-def create_subfiles(gzip_filename, line_limit):
-    print (f'Create subfiles of {gzip_filename} of approximately {line_limit} lines each.')
-    try:
-        subfile_counter = 1
-
-        # clear any old subdata files from previous runs
-        for oldsubdata in glob.glob('subdata*.csv'):
-            os.remove(oldsubdata)
+def read_batches(gzip_filename, line_limit):
+    print (f'Read {gzip_filename} in batches of approximately {line_limit} lines each.')
+    batch_number = 1
+    batch_lines = []
+    writ_basket = None # Basket of the line just added to the batch
 
-        with gzip.open(gzip_filename, 'rt', encoding='utf8') as gzip_f:
-            current_line = gzip_f.readline()
+    with gzip.open(gzip_filename, 'rb') as gzip_raw:
+        # Iterate over a large buffer instead of calling readline, so lines come out of memory rather than
+        # one decompressor call at a time.
+        gzip_f = io.TextIOWrapper(io.BufferedReader(gzip_raw, buffer_size=READ_BUFFER_SIZE), encoding='utf8')
 
-            while current_line:
-                subfile = 'subdata_' + str(subfile_counter).rjust(3,'0') + '.csv'
-                out_f = open(subfile, 'at')
-                line_counter = 0
+        # The input is grouped by basket (generate_data writes every line of a basket together), so a new
+        # batch is only started where the basket id changes once line_limit lines have been collected.
+        for current_line in gzip_f:
+            current_basket = current_line.partition(',')[0]
+            if len(batch_lines) >= line_limit and current_basket != writ_basket:
+                yield batch_number, batch_lines
+                batch_number += 1
+                batch_lines = []
 
-                while line_counter <= line_limit:
-                    # print(f'start line_counter <= line_Limit: line_counter: {line_counter},  line_limit: {line_limit}')  # DEBUG statement
-                    out_f.write(current_line)
-                    writ_basket = current_line # Basket just written to subdata file
-                    current_line = gzip_f.readline() # Next basket in line to be written
-                    if current_line == '':
-                        print(f'No more lines in gzip file to process.')
-                        break
-                    # print(f'Curline#: {line_counter} counter: {line_limit}   just wrote: {writ_basket},  Just read: {current_line}')  # DEBUG statement
+            batch_lines.append(current_line)
+            writ_basket = current_basket
 
-                    # keep baskets in the same file by *not incrementing* if the next basket past the line_limit is the same as the last basket processed.
-                    if (line_counter) == line_limit and current_line == writ_basket: 
-                        continue
-                    else: 
-                        line_counter += 1   
-                    # print(f'About to write Subfile: {subfile}    : current_line: {current_line}')  # DEBUG statement
-                    # print(f'Mem usage during line reads: {round(show_mem(),4)}')  # Reality check that line reads doesn't temporarily inflate mem usage.
-                out_f.close()
-                subfile_counter +=1
-            gzip_f.close()   
-        gc.collect()
+    if batch_lines:
+        yield batch_number, batch_lines
+    print(f'No more lines in gzip file to process.')
 
-    except Exception as err:
-        print(f'Error: {err}')
-        return False
-    return True    
 
 
+def count_batches(pool, batches):
+    # Keep at most BATCHES_IN_FLIGHT batches queued in the pool, so the gzip file is never read further ahead
+    # of the consolidation than that.  The oldest batch is always waited on first, so the results come back
+    # in batch order and the report rows come out in the same order on every run.
+    pending = cll.deque()
+    for batch_number, batch_lines in batches:
+        pending.append(pool.apply_async(proc_and_count, (batch_number, batch_lines)))
+        if len(pending) >= BATCHES_IN_FLIGHT:
+            yield pending.popleft().get()
 
-def proc_baskets(subfile):
-    #print (f'Return dictionary of baskets from input file {subfile} with tuples of products.')
-    basket_dict = {}
-    file_of_baskets = {}
+    while pending:
+        yield pending.popleft().get()
 
-    with open(subfile, 'rt') as f:
-        csv_f = csv.reader(f)
 
-        # Create dictionary of baskets, making the products into a list.
-        for row in csv_f:
-            if row[0] not in basket_dict.keys():
-                basket_dict.update({row[0] : row[1:]})
-            else:
-                basket_dict[row[0]].extend(row[1:])
 
-    # sort and deduplicate the basket contents
-    deduped = {key : sorted(list(set(basket_dict[key]))) for key in sorted(basket_dict)}
-    # print(f'basket_dict\n {basket_dict}') # DEBUG statement
-    # print(f'deduped\n {deduped}') # DEBUG statement
+def proc_and_count(batch_number, batch_lines):
+    #print (f'Return batch {batch_number} with a Counter of the distinct (Product_1, Product_2) tuples of its baskets.')
+    basket_dict = cll.defaultdict(list)
 
-    # Reorganize basket contents into distinct tuples
-    for basket, contents in deduped.items():
-        basket_tuples = {
-            basket : sorted([(e1, e2) for e1 in contents
-                                        for e2 in contents if (e1 < e2)])
-        }
+    # Create dictionary of baskets, making the products into a list of ints.
+    for row in csv.reader(batch_lines):
+        basket_dict[row[0]].extend(map(int, row[1:]))
 
-        # print(basket_tuples)
-        file_of_baskets.update(basket_tuples)
+    # Count the distinct tuples of each sorted and deduplicated basket as they are generated, so the
+    # tuples of a basket are never held in memory beyond the update call.  Packing each tuple into
+    # a single int key makes the Counter about a quarter smaller than with (str, str) tuple keys.
+    summed_tuples = cll.Counter()
+    for contents in basket_dict.values():
+        summed_tuples.update(product_1 << PAIR_SHIFT | product_2 for product_1, product_2 in itl.combinations(sorted(set(contents)), 2))
 
-    gc.collect()
-    return file_of_baskets
+    return batch_number, summed_tuples
 
-     
 
-def count_product_tuples(subfile, file_of_baskets):
-    #print(f'Calculating files of tuple results.')
 
-    tuple_counts_for_subfile = dict(cll.Counter((itl.chain.from_iterable(file_of_baskets.values()))))
-
-    summed_tuples = cll.defaultdict(int) # Creates the empty dictionary in the right format to sum the values.
-
-    for k,v in tuple_counts_for_subfile.items():
-        summed_tuples[k] += v
-
-    count_file = subfile.replace('.csv','_tuplecount.csv')
-
-    with open(count_file,'wt') as out_f:
-        out_csv = csv.writer(out_f)        
-        for row in summed_tuples.items():
-            output_format = []
-            # Format row for csv file - turn the tuples back into lists for final output.
-            output_format.append(list(list(row)[0])[0])
-            output_format.append(list(list(row)[0])[1]) 
-            output_format.append(list(row)[1])
-
-            out_csv.writerow(output_format)
-    
-    gc.collect()
-
-
-
-def proc_subdata(output_filename):
+def proc_subdata(output_filename, batch_counts):
     print("Consolidating results and creating output file.")
-    subdata_list = glob.glob('subdata*tuplecount.csv')
-    subdata_list.sort()
-
-    for proc_file in subdata_list:
-        print(f'Processing proc_file: {proc_file}')
-        if os.path.getsize(proc_file) == 0:
-            #print(f'{proc_file} has been emptied out during processing, so we can skip.')
-            continue
-        proc_df = pd.read_csv(proc_file, header=None)
-        proc_df.columns=['Product_1', 'Product_2', 'num_baskets']
-
-        upd_df = pd.DataFrame(columns=['Product_1', 'Product_2', 'num_baskets'])
-
-        proc_range = list(range(subdata_list.index(proc_file) + 1, len(subdata_list)))
-
-        for next_idx in proc_range:
-            comp_file = subdata_list[next_idx]
-            print(f'    Comparing to: {comp_file}')
 
-            if os.path.getsize(comp_file) == 0:
-                # comparison file has been emptied out already, so we can skip it here too.
-                continue
+    # Each batch's Counter is summed in as soon as it is handed back, per packed (Product_1, Product_2) tuple.
+    # The Counters arrive in batch order, so the report rows come out in the same order on every run.
+    report_counts = cll.Counter()
 
-            comp_df = pd.read_csv(comp_file, header=None)
-            comp_df.columns=['Product_1', 'Product_2', 'num_baskets']
+    for batch_number, summed_tuples in batch_counts:
+        print(f'Consolidating tuple counts of batch: {batch_number}')
+        report_counts.update(summed_tuples)
 
-            mrg_df = pd.merge(proc_df, comp_df, on=['Product_1', 'Product_2'])
+    with open(output_filename, 'wt', buffering=WRITE_BUFFER_SIZE, newline='') as out_f:
+        out_csv = csv.writer(out_f, lineterminator='\n')
+        out_csv.writerow(['Product_1', 'Product_2', 'num_baskets'])
+        # Turn the packed tuples back into flat rows for the csv file.
+        out_csv.writerows((pair >> PAIR_SHIFT, pair & PAIR_MASK, num_baskets) for pair, num_baskets in report_counts.items())
 
-            if mrg_df.empty:
-                del comp_df
-                del mrg_df
-                continue
 
-            upd_df = mrg_df.assign(num_baskets=mrg_df[['num_baskets_x', 'num_baskets_y']].sum(1)).drop(['num_baskets_x', 'num_baskets_y'], axis=1)
-            del mrg_df
-
-            proc_df = pd.merge(proc_df, upd_df, on=['Product_1', 'Product_2'], how='left')
-
-            proc_df = proc_df.assign(num_baskets=proc_df[['num_baskets_x', 'num_baskets_y']].max(1)).drop(['num_baskets_x', 'num_baskets_y'], axis=1)
-            proc_df = proc_df.astype({'num_baskets': int})
-
-            # delete merged row from subfile so it doesn't get counted again.
-            comp_df = pd.merge(comp_df, upd_df, on=['Product_1', 'Product_2'], how='left')
-            comp_drop_idx = (comp_df['num_baskets_y'] > 0).index
-            comp_df.drop(comp_drop_idx, inplace=True)
-
-            comp_df = comp_df.assign(num_baskets=comp_df[['num_baskets_x', 'num_baskets_y']].max(1)).drop(['num_baskets_x', 'num_baskets_y'], axis=1)
-            
-
-            if upd_df.empty == False:
-                comp_df.to_csv(comp_file, mode='wt', header=None, index=False)
-            del comp_df
-
-        if os.path.isfile(output_filename) == False:
-            proc_df.to_csv(output_filename, index=False)
-        else:
-            proc_df.to_csv(output_filename, mode='at', header=None, index=False)
-    gc.collect()
-
-        
 
 if __name__ == '__main__':
     time_at_start = time.time()
@@ -250,20 +160,15 @@ if __name__ == '__main__':
     parser.add_argument('--gzip_filename', default='data_1.csv.gz', type=str )
     parser.add_argument('--reportfile', default='report.csv', type=str)
     parser.add_argument('--line_limit', default=1000, type=int)
+    parser.add_argument('--processes', default=os.cpu_count(), type=int)
     args = parser.parse_args()
 
     print(f'Processing gzip file: {args.gzip_filename}')
 
-    create_subfiles(args.gzip_filename, args.line_limit)
-
-    for subdatafile in glob.glob('subdata*.csv'):
-        basket_out = proc_baskets(subdatafile)
-        count_product_tuples(subdatafile, basket_out)
-
-    proc_subdata(args.reportfile)
-
-    for oldsubdata in glob.glob('subdata*.csv'):
-        os.remove(oldsubdata)
+    # The batches are independent of each other, so they are counted in parallel while the
+    # main process reads ahead from the gzip file and sums up each Counter as it comes back.
+    with mp.Pool(args.processes) as pool:
+        proc_subdata(args.reportfile, count_batches(pool, read_batches(args.gzip_filename, args.line_limit)))
 
     mem_at_end = round(show_mem(),4) 
     time_at_end = time.time() 